@@ -1,4 +1,8 @@
+import heapq
+import weakref
 from dataclasses import dataclass, field, replace
+from functools import lru_cache
+from operator import itemgetter
 from typing import TYPE_CHECKING, Dict, Iterable, List, Optional, Sequence, Tuple, Union
 
 import numpy as np
@@ -15,7 +19,6 @@ if TYPE_CHECKING:
     from .model import Whisper
 
 import kenlm
-import time
 @torch.no_grad()
 def detect_language(
     model: "Whisper", mel: Tensor, tokenizer: Tokenizer = None
@@ -54,20 +57,20 @@ def detect_language(
 
     # forward pass using a single token, startoftranscript
     n_audio = mel.shape[0]
-    x = torch.tensor([[tokenizer.sot]] * n_audio).to(mel.device)  # [n_audio, 1]
+    x = torch.full((n_audio, 1), tokenizer.sot, dtype=torch.long, device=mel.device)
     logits = model.logits(x, mel)[:, 0]
 
-    # collect detected languages; suppress all non-language tokens
-    mask = torch.ones(logits.shape[-1], dtype=torch.bool)
-    mask[list(tokenizer.all_language_tokens)] = False
-    logits[:, mask] = -np.inf
-    language_tokens = logits.argmax(dim=-1)
-    language_token_probs = logits.softmax(dim=-1).cpu()
+    # collect detected languages; only the language tokens are considered, so gather
+    # their logits first and normalize over those columns instead of the whole vocabulary
+    language_token_ids = torch.tensor(
+        list(tokenizer.all_language_tokens), device=logits.device
+    )
+    language_logits = logits[:, language_token_ids].float()
+    language_tokens = language_token_ids[language_logits.argmax(dim=-1)]
+    language_token_probs = language_logits.softmax(dim=-1)
+    language_token_probs = language_token_probs.cpu().tolist()  # a single device sync
     language_probs = [
-        {
-            c: language_token_probs[i, j].item()
-            for j, c in zip(tokenizer.all_language_tokens, tokenizer.all_language_codes)
-        }
+        dict(zip(tokenizer.all_language_codes, language_token_probs[i]))
         for i in range(n_audio)
     ]
 
@@ -89,6 +92,7 @@ class DecodingOptions:
     best_of: Optional[int] = None     # number of independent samples to collect, when t > 0
     beam_size: Optional[int] = None   # number of beams in beam search, when t == 0
     patience: Optional[float] = None  # patience in beam search (https://arxiv.org/abs/2204.05424)
+    early_stopping: bool = False      # end beam search once no active beam can beat a finished one
 
     # options for ranking generations (either beams or best-of-N samples)
     length_penalty: Optional[float] = None   # "alpha" in Google NMT, None defaults to length norm
@@ -108,16 +112,18 @@ class DecodingOptions:
 
     # implementation details
     fp16: bool = True  # use fp16 for most of the calculation
+    compile: bool = False  # use torch.compile for the decoder forward passes
 
     #with LM
     withlm: bool = False
     lm_path: str = None
     lm_alpha: float = 2.0
     lm_beta: float = 2.5
+    lm_fusion: bool = False  # add KenLM shallow fusion to the beam scores; off ranks on whisper alone
     
     #debug
     debug: bool = False
-    #select candidates
+    #select candidates: KenLM scores this many tokens per beam (2 * beam_size if None)
     select_candidates: int = None
 
 
@@ -149,39 +155,109 @@ class Inference:
         pass
 
 
+# a new PyTorchInference is built for every 30-second window and temperature fallback,
+# so the compiled decoder steps are kept here, once per decoder module
+_COMPILED_STEPS: "weakref.WeakKeyDictionary" = weakref.WeakKeyDictionary()
+
+
+def compiled_step(decoder: torch.nn.Module) -> torch.nn.Module:
+    """torch.compile the text decoder for the single-token steps, once per process"""
+    if decoder not in _COMPILED_STEPS:
+        _COMPILED_STEPS[decoder] = torch.compile(decoder, dynamic=True)
+    return _COMPILED_STEPS[decoder]
+
+
 class PyTorchInference(Inference):
-    def __init__(self, model: "Whisper", initial_token_length: int):
+    def __init__(
+        self, model: "Whisper", initial_token_length: int, compile: bool = False
+    ):
         self.model: "Whisper" = model
         self.initial_token_length = initial_token_length
         self.kv_cache = {}
+        self.kv_buffers = {}
         self.hooks = []
 
+        # the first forward pass runs once per task and stays eager; the single-token steps
+        # reuse one compiled wrapper per model, with dynamic shapes for the growing kv_cache
+        self.prefill = self.step = self.model.decoder
+        if compile:
+            self.step = compiled_step(self.model.decoder)
+
+        # only the self-attention caches depend on the beam and need rearranging; the
+        # cross-attention caches are computed once from the (unrepeated) audio features
+        # and broadcast across all beams of an audio, so they are never copied per beam
         key_modules = [block.attn.key for block in self.model.decoder.blocks]
         value_modules = [block.attn.value for block in self.model.decoder.blocks]
         self.kv_modules = key_modules + value_modules
 
+    def install_kv_cache_hooks(self):
+        """
+        Like Whisper.install_kv_cache_hooks, but the self-attention keys and values are written
+        into buffers preallocated for the whole text context instead of concatenated every step.
+        The cache holds views of the filled part, so its lengths still give the decoding offset.
+        Each module has an active and a spare buffer, which rearrange_kv_cache swaps.
+        """
+        cache, hooks = {}, []
+        self_attention = set(self.kv_modules)
+        n_text_ctx = self.model.dims.n_text_ctx
+
+        def save_to_cache(module, _, output):
+            if module not in self_attention:
+                # cross attention: computed once from the audio features and kept as-is
+                cache[module] = output
+                return output
+
+            offset = cache[module].shape[1] if module in cache else 0
+            if module not in self.kv_buffers:
+                shape = (output.shape[0], n_text_ctx, output.shape[-1])
+                self.kv_buffers[module] = [output.new_empty(shape), output.new_empty(shape)]
+            buffer = self.kv_buffers[module][0]
+            end = offset + output.shape[1]
+            buffer[:, offset:end] = output
+            cache[module] = buffer[:, :end]
+            return cache[module]
+
+        for block in self.model.decoder.blocks:
+            for attn in (block.attn, block.cross_attn):
+                if attn is not None:
+                    hooks.append(attn.key.register_forward_hook(save_to_cache))
+                    hooks.append(attn.value.register_forward_hook(save_to_cache))
+
+        return cache, hooks
+
     def logits(self, tokens: Tensor, audio_features: Tensor) -> Tensor:
         if not self.kv_cache:
-            self.kv_cache, self.hooks = self.model.install_kv_cache_hooks()
+            self.kv_cache, self.hooks = self.install_kv_cache_hooks()
 
         if tokens.shape[-1] > self.initial_token_length:
             # only need to use the last token except in the first forward pass
             tokens = tokens[:, -1:]
+            return self.step(tokens, audio_features, kv_cache=self.kv_cache)
 
-        return self.model.decoder(tokens, audio_features, kv_cache=self.kv_cache)
+        return self.prefill(tokens, audio_features, kv_cache=self.kv_cache)
 
     def cleanup_caching(self):
         for hook in self.hooks:
             hook.remove()
 
         self.kv_cache = {}
+        self.kv_buffers = {}
         self.hooks = []
 
     def rearrange_kv_cache(self, source_indices):
-        if source_indices != list(range(len(source_indices))):
+        # beams often keep their order; stop at the first moved beam instead of building a range
+        if not all(i == source for i, source in enumerate(source_indices)):
+            # build the index once on the device instead of once per module from a list
+            source_indices = torch.tensor(source_indices, device=self.model.device)
             for module in self.kv_modules:
-                # update the key/value cache to contain the selected sequences
-                self.kv_cache[module] = self.kv_cache[module][source_indices].detach()
+                # gather the selected sequences into the spare buffer and make it the active one,
+                # so that the reorder writes into preallocated memory only
+                active, spare = self.kv_buffers[module]
+                length = self.kv_cache[module].shape[1]
+                cache = spare[:, :length]
+                torch.index_select(active[:, :length], 0, source_indices, out=cache)
+                self.kv_buffers[module] = [spare, active]
+                self.kv_cache[module] = cache
 
 
 class SequenceRanker:
@@ -278,21 +354,25 @@ class TokenDecoder:
 
 
 class GreedyDecoder(TokenDecoder):
-    def __init__(self, temperature: float, eot: int):
+    def __init__(self, temperature: float, eot: int, debug: bool = False):
         self.temperature = temperature
         self.eot = eot
+        self.debug = debug
 
     def update(
         self, tokens: Tensor, logits: Tensor, sum_logprobs: Tensor
     ) -> Tuple[Tensor, bool]:
-        print("USING GREEDY DECODER LM")
+        if self.debug:
+            print("USING GREEDY DECODER LM")
         if self.temperature == 0:
             next_tokens = logits.argmax(dim=-1)
         else:
             next_tokens = Categorical(logits=logits / self.temperature).sample()
 
-        logprobs = F.log_softmax(logits.float(), dim=-1)
-        current_logprobs = logprobs[torch.arange(logprobs.shape[0]), next_tokens]
+        # log_softmax at the sampled tokens only, without materializing the full distribution
+        current_logprobs = logits[
+            torch.arange(logits.shape[0]), next_tokens
+        ] - torch.logsumexp(logits, dim=-1)
         sum_logprobs += current_logprobs * (tokens[:, -1] != self.eot)
 
         next_tokens[tokens[:, -1] == self.eot] = self.eot
@@ -306,51 +386,143 @@ class GreedyDecoder(TokenDecoder):
         tokens = F.pad(tokens, (0, 1), value=self.eot)
         return tokens, sum_logprobs.tolist()
 
+
+ENGCHAR_PATH = "/home/marvin.rajwadi@CHASEITS/KenLM/juju_test/engchar.txt"
+
+
+@lru_cache(maxsize=1)
+def load_engchar(path: str = ENGCHAR_PATH) -> Tuple[int, ...]:
+    """ids of the tokens allowed as English candidates, one per line in `path`"""
+    with open(path, "r") as file:
+        return tuple(int(line.strip()) for line in file if line.strip())
+
+
+def _top_rows(
+    preceding_tokens: Tensor,
+    sum_logprobs: Tensor,
+    k: int,
+    eot: int,
+    ranking: Optional[Tensor] = None,
+) -> Tuple[List[List[List[int]]], List[List[float]], List[List[float]]]:
+    """
+    The best k unfinished sequences of every audio by `ranking` (default: `sum_logprobs`),
+    EOT-terminated, with their log probs and ranking scores, in one host copy each
+    """
+    if ranking is None:
+        ranking = sum_logprobs
+    top_scores, top_indices = ranking.topk(min(k, ranking.shape[-1]))
+    top_logprobs = top_scores if ranking is sum_logprobs else sum_logprobs.gather(1, top_indices)
+    # append the EOT column on the device and copy the rows of all audio at once
+    top_indices = top_indices[..., None].expand(-1, -1, preceding_tokens.shape[-1])
+    top_rows = F.pad(preceding_tokens.gather(1, top_indices), (0, 1), value=eot)
+    return top_rows.tolist(), top_logprobs.tolist(), top_scores.tolist()
+
+
 class BeamSearchDecoderWithLM(TokenDecoder):
+    # all token ids from 50364 on are timestamp tokens, which the LM has never seen
+    lm_vocab_size: int = 50364
+
     def __init__(self, beam_size: int, eot: int, inference: Inference, patience: Optional[float] = None, 
-                    lm_path: Optional[str] = None, lm_alpha: Optional[float] = 0.5, lm_beta: Optional[float] = 0.5, select_candidates: Optional[int] =100):
+                    lm_path: Optional[str] = None, lm_alpha: Optional[float] = 0.5, lm_beta: Optional[float] = 0.5, select_candidates: Optional[int] =100,
+                    lm_fusion: bool = False, debug: bool = False):
         self.beam_size = beam_size
         self.eot = eot
         self.inference = inference
         self.patience = patience or 1.0
         self.max_candidates: int = round(beam_size * self.patience)
         self.finished_sequences = None
-        self.lm: "kenlm.Model" = kenlm.Model(lm_path) if lm_path else None
+        # with fusion, the beams are ranked on the cumulative fused scores kept here, while
+        # sum_logprobs keeps whisper's own log probs for avg_logprob and the fallbacks
+        self.finished_scores = None
+        self.fused_sum_logprobs: Optional[Tensor] = None
+        self.ranking_logprobs = None
+        self.beam_lm_states: Optional[List["kenlm.State"]] = None
+        # without fusion the beams are ranked on whisper's log probs alone, as before, so the LM
+        # and the English token list are only loaded when fusion is asked for
+        self.lm_fusion = lm_fusion
+        self.lm: "kenlm.Model" = kenlm.Model(lm_path) if lm_fusion else None
         self.tokenizer = get_tokenizer('en')
         self.lm_alpha = lm_alpha
         self.lm_beta = lm_beta
         self.select_candidates = select_candidates
-        with open("/home/marvin.rajwadi@CHASEITS/KenLM/juju_test/engchar.txt", 'r') as file:
-            # Read each line from the file and append to the list
-            data_list = file.readlines()
-            print("datalist loaded")
-
-        # Strip newline characters from each element
-        self.data_list = [int(item.strip()) for item in data_list]
+        self.debug = debug
+        self.skip_len = 4  # the LM skips the first 4 special tokens of the sot_sequence
+        # the KenLM "word" of each text token, built once; EOT is the end of the sentence
+        self.token_chars = [chr(k + 100) for k in range(self.lm_vocab_size)]
+        self.token_chars[eot] = "</s>"
+        self.data_list = load_engchar() if lm_fusion else ()
+        # built on the first update, once the vocabulary size and device are known
+        self.non_english_mask: Optional[Tensor] = None
 
         assert self.max_candidates > 0, f"Invalid beam size ({beam_size}) or patience ({patience})"
    
     def reset(self):
         self.finished_sequences = None
-
-    
+        self.finished_scores = None
+        self.fused_sum_logprobs = None
+        self.ranking_logprobs = None
+        self.beam_lm_states = None
+
+    def _non_english_mask(self, logprobs: Tensor) -> Tensor:
+        """Boolean mask over the vocabulary, True for tokens not listed in engchar.txt"""
+        if self.non_english_mask is None or self.non_english_mask.device != logprobs.device:
+            mask = torch.ones(logprobs.shape[-1], dtype=torch.bool)
+            mask[list(self.data_list)] = False
+            mask[self.eot] = False  # beams must still be able to finish
+            mask[self.lm_vocab_size :] = False  # and timestamps must stay available
+            self.non_english_mask = mask.to(logprobs.device)
+        return self.non_english_mask
+
+    def _lm_advance(self, state: "kenlm.State", token: int) -> "kenlm.State":
+        """Return a new KenLM state that has consumed `token` after `state`"""
+        next_state = kenlm.State()
+        word = self.token_chars[token] if token < self.lm_vocab_size else chr(token + 100)
+        self.lm.BaseScore(state, word, next_state)
+        return next_state
+
+    def _lm_prefix_state(self, prefix: List[int]) -> "kenlm.State":
+        """Run a whole prefix through KenLM, starting from the beginning of a sentence"""
+        state = kenlm.State()
+        self.lm.BeginSentenceWrite(state)
+        for token in prefix:
+            state = self._lm_advance(state, token)
+        return state
+
+    def _lm_candidate_scores(
+        self, states: List["kenlm.State"], candidates: List[List[int]]
+    ) -> np.ndarray:
+        """KenLM log10 scores of each state's candidate tokens; -inf for timestamps"""
+        scratch = kenlm.State()
+        base_score = self.lm.BaseScore
+        token_chars = self.token_chars
+        scores = np.full((len(states), len(candidates[0])), -np.inf, dtype=np.float32)
+        for b, (state, tokens) in enumerate(zip(states, candidates)):
+            for k, token in enumerate(tokens):
+                if token < self.lm_vocab_size:
+                    scores[b, k] = base_score(state, token_chars[token], scratch)
+        return scores
 
     def update(self, tokens: Tensor, logits: Tensor, sum_logprobs: Tensor) -> Tuple[Tensor, bool]:
-        print("USING BEAM DECODER LM")
         if tokens.shape[0] % self.beam_size != 0:
             raise ValueError(f"{tokens.shape}[0] % {self.beam_size} != 0")
 
         n_audio = tokens.shape[0] // self.beam_size
-        print(f"n_audio: {n_audio}, tokens.shape: {tokens.shape}, self.beam_size: {self.beam_size}")
+        if self.debug:
+            print("USING BEAM DECODER LM")
+            print(f"n_audio: {n_audio}, tokens.shape: {tokens.shape}, self.beam_size: {self.beam_size}")
         #print([self.tokenizer.decode(x)[3:] for x in tokens])
-        if self.finished_sequences is None:  # for the first update
+        first_update = self.finished_sequences is None
+        if first_update:
             self.finished_sequences = [{} for _ in range(n_audio)]
+            self.finished_scores = [{} for _ in range(n_audio)]
+            if self.lm_fusion:
+                self.fused_sum_logprobs = sum_logprobs.clone()
 
-        logprobs = F.log_softmax(logits.float(), dim=-1)
+        logprobs = F.log_softmax(logits, dim=-1, dtype=torch.float32)
         # https://github.com/openai/whisper/discussions/361
         # we only use tokenizer token, all token id after 50364 and 50364 are all timestamp tokens
         # because we pass without_timestamp=True to tokenizer, we only get token id < 50364
-        logprobs_for_lm = F.log_softmax(logits.float(), dim=-1)#[:, :50364 + 1]
+        logprobs_for_lm = logprobs  # slice as a view if this ever needs to differ
         
         # def hotspot(prefix_,next_token_):
         #     score_=0
@@ -422,42 +594,6 @@ class BeamSearchDecoderWithLM(TokenDecoder):
         
         #     return final_score
 
-    #     def check_token(x):
-    #         english_chars = [
-    #     'a', 'b', 'c', 'd', 'e', 'f', 'g', 'h', 'i', 'j', 'k', 'l', 'm',
-    #     'n', 'o', 'p', 'q', 'r', 's', 't', 'u', 'v', 'w', 'x', 'y', 'z',
-    #     'A', 'B', 'C', 'D', 'E', 'F', 'G', 'H', 'I', 'J', 'K', 'L', 'M',
-    #     'N', 'O', 'P', 'Q', 'R', 'S', 'T', 'U', 'V', 'W', 'X', 'Y', 'Z',
-    #     '0', '1', '2', '3', '4', '5', '6', '7', '8', '9',#' ',
-    #     ',', '.', '!', '?', ';', ':', "'", '"', '-', '(', ')', '[', ']', '{', '}'
-    # ]
-    #         # Dictionary to hold non-English characters and their IDs
-    #         english_char_ids = []
-    #         # Loop through each ID in the tokenizer's vocabulary
-    #         # for i in range(50364):
-    #         char = tokenizer.decode([x])
-    #         #print(char)
-    #         # Check if the character is non-English by seeing if it's in the English character set
-    #         for k in english_chars:
-    #             #print(k)
-    #             if k in char:
-    #                 return True
-    #             else:
-    #                 t=False
-    #         return False
-        # def check_token(x):
-        #     english_chars = set(
-        #         'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789' +
-        #         ',.!?\';:"-()[]{}'
-        #     )
-        #     # english_chars = set(
-        #     #     'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyzÀÂÆÇÈÉÊËÎÏÔŒÙÛÜàâæçèéêëîïôœùûüÿ' +
-        #     #     ',.!?\';:"-()[]{}'
-        #     # )
-        #     char = self.tokenizer.decode([x])
-        #     # Return True only if all characters in the token are in the English set
-        #     return all(c in english_chars for c in char)
-        
         # # Example usage
         # tokens = ["example", "tokens", "here"]
         # whisper_scores = {"example": -1.0, "tokens": float('-inf'), "here": -0.5}
@@ -468,208 +604,129 @@ class BeamSearchDecoderWithLM(TokenDecoder):
         # print(final_scores)
 
                             
-        #print(self.tokenizer.decode(tokens[0]))
-        #sort logprobs_for_lm in descending order and get values
-        # if self.select_candidates is not None:
-        #     new_logprobs_for_lm=[]
-        #     for i in logprobs_for_lm:
-        #         values, indices = torch.sort(i, descending=True)
-        #         #print([(self.tokenizer.decode([x]),y) for x,y in zip(indices.tolist()[:5],values.tolist()[:5])])
-        #         #select the top n candidates based on whisper log prob
-        #         filtered_indices = []
-        #         for idx in indices:
-        #             if check_token(idx.item()) and len(filtered_indices) < self.select_candidates:
-        #                 filtered_indices.append(idx.item())
-            
-        #         new_logprobs_for_lm.append(filtered_indices)
-                #new_logprobs_for_lm.append(indices.tolist()[:self.select_candidates])
-                # new_logprobs_for_lm.append(filtered_indices)
-            #merge all top 5 logs to get all possible candidate tokens
-            #candidates = np.unique(new_logprobs_for_lm[0]+new_logprobs_for_lm[1]+new_logprobs_for_lm[2]+new_logprobs_for_lm[3]+new_logprobs_for_lm[4])
-            # candidates = new_logprobs_for_lm
-        
-        next_tokens, source_indices, finished_sequences = [], [], []
+        if self.lm_fusion and self.select_candidates is not None:
+            # only English tokens (and EOT) are eligible as candidates
+            logprobs_for_lm = logprobs_for_lm.masked_fill(
+                self._non_english_mask(logprobs_for_lm), -np.inf
+            )
+
+        # no KenLM work at all while the prefix is only the sot_sequence (the first step)
+        if self.lm_fusion and tokens.shape[-1] > self.skip_len:
+            if self.beam_lm_states is None:
+                # the only full pass over the prefixes; each step afterwards extends by one token
+                self.beam_lm_states = [
+                    self._lm_prefix_state(prefix)
+                    for prefix in tokens[:, self.skip_len :].tolist()
+                ]
+
+            # shallow fusion for all beams at once, from the KenLM state after each prefix;
+            # KenLM is only queried for the top candidates of every beam by whisper log prob,
+            # since scoring the whole vocabulary costs one Python-level call per token. every
+            # beam keeps its best beam_size + 1 fused tokens below, so never score fewer
+            # candidates than that (the rest would be -inf fillers), nor more than the vocabulary
+            n_candidates = max(self.select_candidates or 2 * self.beam_size, self.beam_size + 1)
+            n_candidates = min(n_candidates, logprobs_for_lm.shape[-1])
+            candidate_logprobs, candidate_tokens = logprobs_for_lm.topk(n_candidates, dim=-1)
+            candidates = candidate_tokens.tolist()
+            lm_score = self._lm_candidate_scores(self.beam_lm_states, candidates)
+            lm_score = torch.from_numpy(lm_score).to(logprobs_for_lm.device)
+            # timestamps have no KenLM word and keep whisper's log prob; fusing them to -inf
+            # leaves nothing to pick on steps where ApplyTimestampRules masks all text tokens.
+            # their -inf scores are zeroed before scaling, as lm_alpha == 0 would turn them NaN
+            no_lm_word = torch.isinf(lm_score)
+            lm_bonus = self.lm_alpha * lm_score.masked_fill(no_lm_word, 0) + self.lm_beta
+            fused_candidates = torch.where(
+                no_lm_word, candidate_logprobs, candidate_logprobs + lm_bonus
+            )
+            # the rest of the vocabulary stays at -inf
+            fused_logprobs = torch.full_like(logprobs_for_lm, -np.inf)
+            fused_logprobs.scatter_(-1, candidate_tokens, fused_candidates)
+            logprobs_for_lm = fused_logprobs
+
+        # STEP 1: calculate the cumulative log probabilities for possible candidates,
+        # for all beams in one broadcast add and one host copy
+        top_scores, top_tokens = logprobs_for_lm.topk(self.beam_size + 1)
+        if self.debug:
+            step_logprobs = top_scores.tolist()
+        if self.lm_fusion:
+            # rank on the fused scores, but keep accumulating whisper's own log probs
+            top_logprobs = (sum_logprobs[:, None] + logprobs.gather(-1, top_tokens)).tolist()
+            top_scores = (self.fused_sum_logprobs[:, None] + top_scores).tolist()
+        else:
+            top_logprobs = top_scores = (sum_logprobs[:, None] + top_scores).tolist()
+        top_tokens = top_tokens.tolist()
+
+        # the prefixes are copied to the host only for debugging or once a sequence finishes
+        prefixes = tokens.tolist() if self.debug else None
+        next_tokens, source_indices, next_scores = [], [], []
         #print("n_audio: ",n_audio)
-        #start time 
         for i in range(int(n_audio)):
-            #print("start")
-            start = time.time()
-            scores, sources, finished = {}, {}, {}
+            scores = {}
+            finished = self.finished_sequences[i]
+            finished_scores = self.finished_scores[i]
 
-            # STEP 1: calculate the cumulative log probabilities for possible candidates
-            for j in range(self.beam_size):
+            # all beams still hold the same prefix on the first update; only extend the first
+            # one, so that every remaining (beam, token) pair stands for a distinct sequence
+            for j in range(1 if first_update else self.beam_size):
                 idx = i * self.beam_size + j
-                prefix = tokens[idx].tolist()
-                skip_len=prefix.index(50258)
-                if skip_len <0:
-                    skip_len = 0
-                #skip_len = skip_len+4
-                skip_len=4
-                print(self.tokenizer.decode(prefix))
-                #print(skip_len)
-                #break
-                lm_score = [float("-inf")]*4
-                # we skip first 4 special tokens
-                if (len(prefix) > skip_len):
-                    curr_state = kenlm.State()
-                    next_state = kenlm.State()
-                    self.lm.BeginSentenceWrite(curr_state)
-                    # lm_score = []
-                    prob = 0.0
-                    for k in range(len(prefix[skip_len:])):
-                        prob += self.lm.BaseScore(curr_state, chr(prefix[k + skip_len] + 100), next_state)
-                        curr_state, next_state = next_state, curr_state
-                    # save last state so that we do not have to recompute the whole sentence
-                    last_state = curr_state
-                    
-                    # calculate all log10 probabilities of all tokens
-                    # this is not efficient: https://github.com/kpu/kenlm/issues/367
-                #     if self.select_candidates is not None:
-                #         print([self.tokenizer.decode([x]) for x in candidates[idx]])
-                #         for k in candidates[idx]:
-                #             new_token_state = kenlm.State()
-                #             #new_token_score = self.lm.BaseScore(last_state, chr(k + 100), new_token_state)
-                #             #boost hotwords
-                #             # lm_hw = hotspot(prefix,k)
-                #             # #logprobs_for_lm[idx][k] = logprobs_for_lm[idx][k]+ self.lm_alpha*new_token_score + self.lm_beta
-                #             # if lm_hw != 0:
-                #             #     print("++++++++++++++++")
-                #             #     logprobs_for_lm[idx][k] =logprobs_for_lm[idx][k] + lm_hw
-                #             #     #logprobs_for_lm[idx][k] =lm_hw
-                                
-                #             # # else:
-                #             # #     logprobs_for_lm[idx][k] =logprobs_for_lm[idx][k] + self.lm_alpha * self.lm.BaseScore(last_state, chr(k + 100), new_token_state)
-                #             # else:
-                #             # if True:
-                #             #lm_hw = self.lm_alpha * self.lm.BaseScore(last_state, chr(k + 100), new_token_state)
-                #             #logprobs_for_lm[idx][k] =logprobs_for_lm[idx][k]+lm_hw
-                #             # print(lm_hw)
-
-                            
-                #             # lm_hw= -1.9
-                #             # #logprobs_for_lm[idx][k] =logprobs_for_lm[idx][k]+lm_hw
-                #             # before= logprobs[idx][k]
-                #             # new_score = calculate_final_scores(logprobs_for_lm[idx][k],lm_hw,k)
-                #             # logprobs_for_lm[idx][k] = new_score
-                            
-                            
-                #             #print(f"kenlm new token score: {self.tokenizer.decode([k])} : {lm_hw}  Shallow fusion : {logprobs_for_lm[idx][k] } whisper: {before}  score: {new_score}")
-                        
-                #             # else:
-                #             #     lm_hw=float("-inf")
-                #             #lm_score.append(lm_hw)
-                #             #lm_score.append(float("-inf"))
-                #             #print(f"kenlm new token score: {self.tokenizer.decode([k])} : {new_token_score}")
-                #         #print(f"kenlm new token score: {self.tokenizer.decode([np.argmax(lm_score)])}")
-
-                #         ###################################
-                        
-                #         #lm_score.append(self.lm.BaseScore(last_state, "</s>", new_token_state))
-                
-                #         ##############################################################################
-                        
-                        
-
-
-                #         # new_score = [float('-inf')]*50365
-                        
-                #         # for idc,c in enumerate(candidates[j]):
-                #         #     # assign index values of lm score to new_score
-                #         #     new_score[c] = lm_score[idc]
-                #         #     #logprobs_for_lm[idx][c] = self.lm_alpha * lm_score[idc]+ (1 - self.lm_alpha) * logprobs_for_lm[idx][c]
-                #         #     #logprobs_for_lm[idx][c] = lm_score[idc]+logprobs_for_lm[idx][c]
-                #         # #new_score[50257] = self.lm.BaseScore(last_state, "</s>", new_token_state)
-                #         # lm_score = new_score
-                #         # lm_score = torch.FloatTensor(lm_score).to(tokens.device)
-
-                #     else:
-                #         for k in range(50364):
-                #             new_token_state = kenlm.State()
-                #             new_token_score = self.lm.BaseScore(last_state, chr(k + 100), new_token_state)
-                #             lm_score.append(new_token_score)
-                #         # print(f"kenlm new token score: {self.tokenizer.decode(np.argmax(new_token_score))}")
-                #         # print(self.tokenizer.decode(prefix))
-                #         # add <endoftext> token's probability, which is </s> in kenlm
-                #         #lm_score.append(self.lm.BaseScore(last_state, "</s>", new_token_state))
-                #         lm_score = torch.FloatTensor(lm_score).to(tokens.device)
-
-                    
-
-                    
-                #     # common shallow fusion
-                #     #temp_logprobs_idx = logprobs_for_lm[idx] + self.lm_alpha*lm_score#+5.5
-                #     temp_logprobs_idx=logprobs_for_lm[idx]#+ self.lm_alpha*lm_score + self.lm_beta#*len(prefix)
-                #     # print("################################################################")
-                #     # print(self.tokenizer.decode(temp_logprobs_idx.topk(self.beam_size + 1)[1]))
-                #     # print(len(temp_logprobs_idx.topk(self.beam_size + 1)))
-                #     # temp_logprobs_idx = self.lm_alpha*lm_score
-                # else:
-                #     temp_logprobs_idx = logprobs_for_lm[idx]
-
-                # def get_top_k_elements_with_indices_np(data, k):
-                #             # Convert data to a numpy array
-                #             data_array = np.array(data)
-                #             # Get the indices of the top k elements in descending order
-                #             top_k_indices = np.argsort(-data_array)[:k]
-                #             # Extract the top k values using these indices
-                #             top_k_values = data_array[top_k_indices]
-                #             # Return a list of tuples containing indices and values
-                #             return list(zip(top_k_indices, top_k_values))
-                        
-                # top_kc = get_top_k_elements_with_indices_np(lm_score, 5)
-                        
-                # Display the result
-                #print("Top 3 elements with indices:")
-                # for index, value in top_kc:
-                #     #print(f"Index: {index}, Value: {value}")
-                #     print(f"kenlm new token score: {self.tokenizer.decode([candidates[idx][index]])} : {value}")
-                # ###############################################################################
-                # # create a empty list to mtch whisper lm shape of 50365
-                # # new_score=[0.0]*50365
-
-                for logprob, token in zip(*logprobs_for_lm[idx].topk(self.beam_size + 1)):
-                    #print("################################################################")
-                    print(f"whisper top k: {self.tokenizer.decode([token])} {logprob}")
-                    logprob = (sum_logprobs[idx] + logprob).item() 
-                    sequence = tuple(prefix + [token.item()])
-                    scores[sequence] = logprob
-                    sources[sequence] = idx
+                if self.debug:
+                    print(self.tokenizer.decode(prefixes[idx]))
+                    for logprob, token in zip(step_logprobs[idx], top_tokens[idx]):
+                        print(f"whisper top k: {self.tokenizer.decode([token])} {logprob}")
+                for score, logprob, token in zip(
+                    top_scores[idx], top_logprobs[idx], top_tokens[idx]
+                ):
+                    scores[(idx, token)] = (score, logprob)
             #print(f"Scores: {scores}")
-            #print(f"Sources: {sources}")
             # STEP 2: rank the candidates and keep the top beam_size sequences for each audio
+            # each beam contributes at most one EOT, so the ranking below never walks past
+            # the best 2 * beam_size candidates; no need to sort all of them
             saved = 0
-            for sequence in sorted(scores, key=scores.get, reverse=True):
-                print(self.tokenizer.decode(sequence), scores[sequence])
-                if sequence[-1] == self.eot:
-                    finished[sequence] = scores[sequence]
+            ranked = heapq.nlargest(2 * self.beam_size, scores.items(), key=itemgetter(1))
+            for (source, token), (score, logprob) in ranked:
+                if self.debug:
+                    print(self.tokenizer.decode(prefixes[source] + [token]), score)
+                if token == self.eot:
+                    # candidates arrive best first, so the list keeps the best ones when full
+                    if len(finished) < self.max_candidates:
+                        if prefixes is None:
+                            prefixes = tokens.tolist()
+                        sequence = tuple(prefixes[source] + [token])
+                        if self.debug:
+                            print("fin: ",self.tokenizer.decode(sequence))
+                        finished[sequence] = logprob
+                        finished_scores[sequence] = score
                 else:
-                    sum_logprobs[len(next_tokens)] = scores[sequence]
-                    next_tokens.append(sequence)
-                    source_indices.append(sources[sequence])
+                    sum_logprobs[len(next_tokens)] = logprob
+                    next_tokens.append(token)
+                    source_indices.append(source)
+                    next_scores.append(score)
 
                     saved += 1
                     if saved == self.beam_size:
                         break
 
-            finished_sequences.append(finished)
-            stop = time.time()
-            print("time for token gen beamdecoderLM: ",stop-start)
-        #stop time
-        tokens = torch.tensor(next_tokens, device=tokens.device)
+        # gather the surviving prefixes on the device and append the new column to them
+        tokens = torch.cat(
+            [
+                tokens.index_select(0, torch.tensor(source_indices, device=tokens.device)),
+                torch.tensor(next_tokens, device=tokens.device)[:, None],
+            ],
+            dim=-1,
+        )
         #for x_o in tokens:
             #print(f"finished: {self.tokenizer.decode(x_o)}")
-        print("---------------------------------------------")
+        if self.debug:
+            print("---------------------------------------------")
         self.inference.rearrange_kv_cache(source_indices)
-
-        # add newly finished sequences to self.finished_sequences
-        assert len(self.finished_sequences) == len(finished_sequences)
-        for previously_finished, newly_finished in zip(self.finished_sequences, finished_sequences):
-            print("prev fin: ",[self.tokenizer.decode(g) for g in previously_finished])
-            for seq in sorted(newly_finished, key=newly_finished.get, reverse=True):
-                print("fin: ",self.tokenizer.decode(seq))
-                if len(previously_finished) >= self.max_candidates:
-                    break  # the candidate list is full
-                previously_finished[seq] = newly_finished[seq]
+        if self.lm_fusion:
+            self.fused_sum_logprobs = torch.tensor(next_scores, device=sum_logprobs.device)
+        if self.beam_lm_states is not None:
+            # move the LM states along with the beams, extended by the selected token
+            self.beam_lm_states = [
+                self._lm_advance(self.beam_lm_states[source], token)
+                for source, token in zip(source_indices, next_tokens)
+            ]
 
         # mark as completed if all audio has enough number of samples
         completed = all(
@@ -681,13 +738,19 @@ class BeamSearchDecoderWithLM(TokenDecoder):
 
     def finalize(self, preceding_tokens: Tensor, sum_logprobs: Tensor):
         # collect all finished sequences, including patience, and add unfinished ones if not enough
-        sum_logprobs = sum_logprobs.cpu()
+        ranking = self.fused_sum_logprobs.view_as(sum_logprobs) if self.lm_fusion else None
+        top_rows = top_logprobs = top_scores = None
         for i, sequences in enumerate(self.finished_sequences):
             #print("finished: ", sequences)
+            scores = self.finished_scores[i]
             if len(sequences) < self.beam_size:  # when not enough sequences are finished
-                for j in list(np.argsort(sum_logprobs[i]))[::-1]:
-                    sequence = preceding_tokens[i, j].tolist() + [self.eot]
-                    sequences[tuple(sequence)] = sum_logprobs[i][j].item()
+                if top_rows is None:
+                    top_rows, top_logprobs, top_scores = _top_rows(
+                        preceding_tokens, sum_logprobs, self.beam_size, self.eot, ranking
+                    )
+                for sequence, logprob, score in zip(top_rows[i], top_logprobs[i], top_scores[i]):
+                    sequences[tuple(sequence)] = logprob
+                    scores[tuple(sequence)] = score
                     if len(sequences) >= self.beam_size:
                         break
 
@@ -697,6 +760,11 @@ class BeamSearchDecoderWithLM(TokenDecoder):
         sum_logprobs: List[List[float]] = [
             list(sequences.values()) for sequences in self.finished_sequences
         ]
+        # the scores to rank the finished sequences on, which differ from the returned
+        # log probs only with fusion; both lists follow the same key order
+        self.ranking_logprobs: List[List[float]] = [
+            list(scores.values()) for scores in self.finished_scores
+        ]
         return tokens, sum_logprobs
 
 
@@ -707,27 +775,23 @@ class BeamSearchDecoder(TokenDecoder):
         eot: int,
         inference: Inference,
         patience: Optional[float] = None,
+        early_stopping: bool = False,
     ):
         self.beam_size = beam_size
         self.eot = eot
         self.inference = inference
         self.patience = patience or 1.0
+        self.early_stopping = early_stopping
         self.max_candidates: int = round(beam_size * self.patience)
         self.finished_sequences = None
-        with open("/home/marvin.rajwadi@CHASEITS/KenLM/juju_test/engchar.txt", 'r') as file:
-            # Read each line from the file and append to the list
-            data_list = file.readlines()
-            print("datalist loaded")
-
-        # Strip newline characters from each element
-        self.data_list = [int(item.strip()) for item in data_list]
-        self.tokenizer = get_tokenizer('en')
+        self.stopped_early = None
         assert (
             self.max_candidates > 0
         ), f"Invalid beam size ({beam_size}) or patience ({patience})"
 
     def reset(self):
         self.finished_sequences = None
+        self.stopped_early = None
 
 
     def update(
@@ -737,81 +801,94 @@ class BeamSearchDecoder(TokenDecoder):
             raise ValueError(f"{tokens.shape}[0] % {self.beam_size} != 0")
 
         n_audio = tokens.shape[0] // self.beam_size
-        if self.finished_sequences is None:  # for the first update
+        first_update = self.finished_sequences is None
+        if first_update:
             self.finished_sequences = [{} for _ in range(n_audio)]
-
-        logprobs = F.log_softmax(logits.float(), dim=-1)
-        # with open("/home/marvin.rajwadi@CHASEITS/miniconda3/envs/kenlm/lib/python3.10/site-packages/whisper/whisper-KenLM/engchar.txt", 'r') as file:
-        #     # Read each line from the file and append to the list
-        #     data_list = file.readlines()
-
-        # # Strip newline characters from each element
-        # data_list = [int(item.strip()) for item in data_list]
-        next_tokens, source_indices, finished_sequences = [], [], []
+            self.stopped_early = [False] * n_audio
+
+        logprobs = F.log_softmax(logits, dim=-1, dtype=torch.float32)
+        vocab_size = logprobs.shape[-1]
+
+        # STEP 1: calculate the cumulative log probabilities for possible candidates,
+        # for every (beam, token) pair of an audio at once
+        candidate_logprobs = (sum_logprobs[:, None] + logprobs).view(n_audio, -1)
+        if first_update:
+            # all beams still hold the same prefix; only extend the first one of each audio
+            candidate_logprobs.view(n_audio, self.beam_size, -1)[:, 1:] = -np.inf
+        # each beam contributes at most one EOT, so the best 2 * beam_size candidates always
+        # contain the beam_size unfinished ones that the ranking below walks through
+        top_logprobs, top_indices = candidate_logprobs.topk(2 * self.beam_size)
+        top_logprobs, top_indices = top_logprobs.tolist(), top_indices.tolist()
+
+        prefixes = None  # copied to the host only once a sequence finishes
+        next_tokens, source_indices = [], []
         for i in range(n_audio):
-            scores, sources, finished = {}, {}, {}
-
-            # STEP 1: calculate the cumulative log probabilities for possible candidates
-            for j in range(self.beam_size):
-                idx = i * self.beam_size + j
-                prefix = tokens[idx].tolist()
-                print(self.tokenizer.decode(prefix))
-                # for idx_,c in enumerate(logprobs[idx]):
-                #     if idx_ !=self.data_list:
-                #         logprobs[idx][idx_]=float("-inf")
-                for logprob, token in zip(*logprobs[idx].topk(self.beam_size + 1)):
-                    print(f"whisper top k: {self.tokenizer.decode([token])} {logprob}")
-                    new_logprob = (sum_logprobs[idx] + logprob).item()
-                    sequence = tuple(prefix + [token.item()])
-                    scores[sequence] = new_logprob
-                    sources[sequence] = idx
+            finished = self.finished_sequences[i]
 
             # STEP 2: rank the candidates and keep the top beam_size sequences for each audio
             saved = 0
-            for sequence in sorted(scores, key=scores.get, reverse=True):
-                if sequence[-1] == self.eot:
-                    finished[sequence] = scores[sequence]
+            for logprob, index in zip(top_logprobs[i], top_indices[i]):
+                source = i * self.beam_size + index // vocab_size
+                token = index % vocab_size
+                if token == self.eot:
+                    # candidates arrive best first, so the list keeps the best ones when full
+                    if len(finished) < self.max_candidates:
+                        if prefixes is None:
+                            prefixes = tokens.tolist()
+                        finished[tuple(prefixes[source] + [token])] = logprob
                 else:
-                    sum_logprobs[len(next_tokens)] = scores[sequence]
-                    next_tokens.append(sequence)
-                    source_indices.append(sources[sequence])
+                    sum_logprobs[len(next_tokens)] = logprob
+                    next_tokens.append(token)
+                    source_indices.append(source)
 
                     saved += 1
                     if saved == self.beam_size:
                         break
 
-            finished_sequences.append(finished)
-
-        tokens = torch.tensor(next_tokens, device=tokens.device)
+        # gather the surviving prefixes on the device and append the new column to them
+        tokens = torch.cat(
+            [
+                tokens.index_select(0, torch.tensor(source_indices, device=tokens.device)),
+                torch.tensor(next_tokens, device=tokens.device)[:, None],
+            ],
+            dim=-1,
+        )
         self.inference.rearrange_kv_cache(source_indices)
 
-        # add newly finished sequences to self.finished_sequences
-        assert len(self.finished_sequences) == len(finished_sequences)
-        for previously_finished, newly_finished in zip(
-            self.finished_sequences, finished_sequences
-        ):
-            for seq in sorted(newly_finished, key=newly_finished.get, reverse=True):
-                if len(previously_finished) >= self.max_candidates:
-                    break  # the candidate list is full
-                previously_finished[seq] = newly_finished[seq]
-
         # mark as completed if all audio has enough number of samples
         completed = all(
             len(sequences) >= self.max_candidates
             for sequences in self.finished_sequences
         )
+        if self.early_stopping and not completed:
+            # cumulative log probabilities never increase, so an audio whose best finished
+            # sequence already outscores all of its active beams cannot improve any further
+            best_active = sum_logprobs.view(n_audio, self.beam_size).max(dim=-1).values
+            for i, best in enumerate(best_active.tolist()):
+                sequences = self.finished_sequences[i]
+                if len(sequences) > 0 and max(sequences.values()) > best:
+                    self.stopped_early[i] = True
+            completed = all(
+                len(sequences) >= self.max_candidates or stopped
+                for sequences, stopped in zip(self.finished_sequences, self.stopped_early)
+            )
         return tokens, completed
 
     def finalize(self, preceding_tokens: Tensor, sum_logprobs: Tensor):
         # collect all finished sequences, including patience, and add unfinished ones if not enough
-        sum_logprobs = sum_logprobs.cpu()
+        top_rows = top_logprobs = None
         for i, sequences in enumerate(self.finished_sequences):
+            # an audio that stopped early keeps only its finished sequences: its active beams
+            # are cut off mid-sentence, yet could still win after length normalization
             if (
-                len(sequences) < self.beam_size
+                len(sequences) < self.beam_size and not self.stopped_early[i]
             ):  # when not enough sequences are finished
-                for j in list(np.argsort(sum_logprobs[i]))[::-1]:
-                    sequence = preceding_tokens[i, j].tolist() + [self.eot]
-                    sequences[tuple(sequence)] = sum_logprobs[i][j].item()
+                if top_rows is None:
+                    top_rows, top_logprobs, _ = _top_rows(
+                        preceding_tokens, sum_logprobs, self.beam_size, self.eot
+                    )
+                for sequence, logprob in zip(top_rows[i], top_logprobs[i]):
+                    sequences[tuple(sequence)] = logprob
                     if len(sequences) >= self.beam_size:
                         break
 
@@ -854,9 +931,13 @@ class SuppressBlank(LogitFilter):
 class SuppressTokens(LogitFilter):
     def __init__(self, suppress_tokens: Sequence[int]):
         self.suppress_tokens = list(suppress_tokens)
+        # index tensor built once and moved to the logits device on first use
+        self.suppress_index = torch.as_tensor(self.suppress_tokens, dtype=torch.long)
 
     def apply(self, logits: Tensor, tokens: Tensor):
-        logits[:, self.suppress_tokens] = -np.inf
+        if self.suppress_index.device != logits.device:
+            self.suppress_index = self.suppress_index.to(logits.device)
+        logits[:, self.suppress_index] = -np.inf
 
 
 class ApplyTimestampRules(LogitFilter):
@@ -869,6 +950,16 @@ class ApplyTimestampRules(LogitFilter):
         self.tokenizer = tokenizer
         self.sample_begin = sample_begin
         self.max_initial_timestamp_index = max_initial_timestamp_index
+        self.vocab_index: Optional[Tensor] = None  # column ids, reused across steps
+
+    def _get_vocab_index(self, logits: Tensor) -> Tensor:
+        if (
+            self.vocab_index is None
+            or self.vocab_index.device != logits.device
+            or self.vocab_index.shape[0] != logits.shape[-1]
+        ):
+            self.vocab_index = torch.arange(logits.shape[-1], device=logits.device)
+        return self.vocab_index
 
     def apply(self, logits: Tensor, tokens: Tensor):
         # suppress <|notimestamps|> which is handled by without_timestamps
@@ -876,33 +967,38 @@ class ApplyTimestampRules(LogitFilter):
             logits[:, self.tokenizer.no_timestamps] = -np.inf
 
         # timestamps have to appear in pairs, except directly before EOT; mask logits accordingly
-        for k in range(tokens.shape[0]):
-            sampled_tokens = tokens[k, self.sample_begin :]
-            seq = [t for t in sampled_tokens.tolist()]
-            last_was_timestamp = (
-                len(seq) >= 1 and seq[-1] >= self.tokenizer.timestamp_begin
-            )
-            penultimate_was_timestamp = (
-                len(seq) < 2 or seq[-2] >= self.tokenizer.timestamp_begin
+        sampled_tokens = tokens[:, self.sample_begin :]
+        n_sampled = sampled_tokens.shape[1]
+        if n_sampled > 0:
+            timestamp_begin = self.tokenizer.timestamp_begin
+            vocab_index = self._get_vocab_index(logits)
+            is_timestamp = sampled_tokens >= timestamp_begin
+            last_was_timestamp = is_timestamp[:, -1]
+            if n_sampled >= 2:
+                penultimate_was_timestamp = is_timestamp[:, -2]
+            else:
+                penultimate_was_timestamp = torch.ones_like(last_was_timestamp)
+            only_pair_end = last_was_timestamp & ~penultimate_was_timestamp
+
+            mask = (last_was_timestamp & penultimate_was_timestamp)[:, None] & (
+                vocab_index >= timestamp_begin
+            )  # has to be non-timestamp
+            mask |= only_pair_end[:, None] & (
+                vocab_index < self.tokenizer.eot
+            )  # cannot be normal text tokens
+
+            # timestamps shouldn't decrease; forbid timestamp tokens smaller than the last
+            # also force each segment to have a nonzero length, to prevent infinite looping
+            positions = torch.arange(n_sampled, device=tokens.device)
+            last_position = torch.where(is_timestamp, positions, -1).amax(dim=-1)
+            timestamp_last = sampled_tokens.gather(1, last_position.clamp(min=0)[:, None])
+            timestamp_last = timestamp_last + (~only_pair_end[:, None]).long()
+            mask |= (
+                (last_position >= 0)[:, None]
+                & (vocab_index >= timestamp_begin)
+                & (vocab_index < timestamp_last)
             )
-
-            if last_was_timestamp:
-                if penultimate_was_timestamp:  # has to be non-timestamp
-                    logits[k, self.tokenizer.timestamp_begin :] = -np.inf
-                else:  # cannot be normal text tokens
-                    logits[k, : self.tokenizer.eot] = -np.inf
-
-            timestamps = sampled_tokens[
-                sampled_tokens.ge(self.tokenizer.timestamp_begin)
-            ]
-            if timestamps.numel() > 0:
-                # timestamps shouldn't decrease; forbid timestamp tokens smaller than the last
-                # also force each segment to have a nonzero length, to prevent infinite looping
-                if last_was_timestamp and not penultimate_was_timestamp:
-                    timestamp_last = timestamps[-1]
-                else:
-                    timestamp_last = timestamps[-1] + 1
-                logits[k, self.tokenizer.timestamp_begin : timestamp_last] = -np.inf
+            logits.masked_fill_(mask, -np.inf)
 
         if tokens.shape[1] == self.sample_begin:
             # suppress generating non-timestamp tokens at the beginning
@@ -916,14 +1012,38 @@ class ApplyTimestampRules(LogitFilter):
                 logits[:, last_allowed + 1 :] = -np.inf
 
         # if sum of probability over timestamps is above any other token, sample timestamp
-        logprobs = F.log_softmax(logits.float(), dim=-1)
-        for k in range(tokens.shape[0]):
-            timestamp_logprob = logprobs[k, self.tokenizer.timestamp_begin :].logsumexp(
-                dim=-1
-            )
-            max_text_token_logprob = logprobs[k, : self.tokenizer.timestamp_begin].max()
-            if timestamp_logprob > max_text_token_logprob:
-                logits[k, : self.tokenizer.timestamp_begin] = -np.inf
+        logprobs = F.log_softmax(logits, dim=-1, dtype=torch.float32)
+        timestamp_logprob = logprobs[:, self.tokenizer.timestamp_begin :].logsumexp(dim=-1)
+        max_text_token_logprob = logprobs[:, : self.tokenizer.timestamp_begin].amax(dim=-1)
+        logits[:, : self.tokenizer.timestamp_begin].masked_fill_(
+            (timestamp_logprob > max_text_token_logprob)[:, None], -np.inf
+        )
+
+
+class LanguageIdentification:
+    def __init__(self, pretrained_lang_model: str):
+        # only the non-English LM penalty needs fastText, so the other decoding paths don't
+        import fasttext
+
+        self.model = fasttext.load_model(pretrained_lang_model)
+
+    def predict_lang(self, texts: List[str]) -> List[str]:
+        # fastText batches a list of lines natively, but each line must not contain newlines
+        labels, _ = self.model.predict([text.replace("\n", " ") for text in texts], k=1)
+        return [label[0].split("__")[-1].strip() for label in labels]
+
+
+LID_MODEL_PATH = "/home/marvin.rajwadi@CHASEITS/KenLM/juju_test/fasttext/lid.176.ftz"
+
+_LANG_ID: Optional[LanguageIdentification] = None
+
+
+def get_language_identification() -> LanguageIdentification:
+    """load the fastText language identification model once per process"""
+    global _LANG_ID
+    if _LANG_ID is None:
+        _LANG_ID = LanguageIdentification(LID_MODEL_PATH)
+    return _LANG_ID
 
 
 class DecodingTask:
@@ -958,7 +1078,9 @@ class DecodingTask:
         self.sot_index: int = self.initial_tokens.index(tokenizer.sot)
 
         # inference: implements the forward pass through the decoder, including kv caching
-        self.inference = PyTorchInference(model, len(self.initial_tokens))
+        self.inference = PyTorchInference(
+            model, len(self.initial_tokens), options.compile
+        )
 
         # sequence ranker: implements how to rank a group of sampled sequences
         self.sequence_ranker = MaximumLikelihoodRanker(options.length_penalty)
@@ -966,20 +1088,28 @@ class DecodingTask:
         # decoder: implements how to select the next tokens, given the autoregressive distribution
         if options.beam_size is not None:
             if (options.withlm):
-                if options.select_candidates is not None:
-                    print(f"Running KenLM on selected {options.select_candidates} candidates.")
-                else:
-                    print(f"Running KenLM on all {50365} tokens.")
+                if options.debug and options.lm_fusion:
+                    n_candidates = max(
+                        options.select_candidates or 2 * options.beam_size, options.beam_size + 1
+                    )
+                    print(f"Running KenLM on selected {n_candidates} candidates.")
                 self.decoder = BeamSearchDecoderWithLM(
                     options.beam_size, tokenizer.eot, self.inference, options.patience, 
-                    options.lm_path, options.lm_alpha, options.lm_beta, options.select_candidates
+                    options.lm_path, options.lm_alpha, options.lm_beta, options.select_candidates,
+                    options.lm_fusion, options.debug,
                 )
             else:
                 self.decoder = BeamSearchDecoder(
-                    options.beam_size, tokenizer.eot, self.inference, options.patience
+                    options.beam_size,
+                    tokenizer.eot,
+                    self.inference,
+                    options.patience,
+                    options.early_stopping,
                 )
         else:
-            self.decoder = GreedyDecoder(options.temperature, tokenizer.eot)
+            self.decoder = GreedyDecoder(
+                options.temperature, tokenizer.eot, options.debug
+            )
 
         # logit filters: applies various rules to suppress or penalize certain tokens
         self.logit_filters = []
@@ -1008,6 +1138,10 @@ class DecodingTask:
                 raise ValueError("best_of with greedy sampling (T=0) is not compatible")
         if options.patience is not None and options.beam_size is None:
             raise ValueError("patience requires beam_size to be given")
+        if options.early_stopping and (options.beam_size is None or options.withlm):
+            raise ValueError("early_stopping requires beam_size to be given, without withlm")
+        if options.lm_fusion and not (options.withlm and options.lm_path):
+            raise ValueError("lm_fusion requires withlm and an lm_path to be given")
         if options.length_penalty is not None and not (
             0 <= options.length_penalty <= 1
         ):
@@ -1120,7 +1254,9 @@ class DecodingTask:
                 if (
                     i == 0 and self.tokenizer.no_speech is not None
                 ):  # save no_speech_probs
-                    probs_at_sot = logits[:, self.sot_index].float().softmax(dim=-1)
+                    probs_at_sot = logits[:, self.sot_index].softmax(
+                        dim=-1, dtype=torch.float32
+                    )
                     no_speech_probs = probs_at_sot[:, self.tokenizer.no_speech].tolist()
 
                 # now we need to consider the logits at the last token only
@@ -1181,35 +1317,28 @@ class DecodingTask:
             [t[self.sample_begin : (t == tokenizer.eot).nonzero()[0, 0]] for t in s]
             for s in tokens
         ]
+        # with LM fusion the sequences are ranked on their fused scores, while avg_logprob
+        # below keeps reporting whisper's own log probs
+        ranking_logprobs = sum_logprobs
+        if self.options.lm_fusion and isinstance(self.decoder, BeamSearchDecoderWithLM):
+            ranking_logprobs = self.decoder.ranking_logprobs
         tokens_en=[]
         tokens_en_sc=[]
         tokens_bs=[]
         tokens_bs_sc =[]
-        import fasttext
-        from langdetect import detect
-
-
-        class LanguageIdentification:
-        
-            def __init__(self):
-                pretrained_lang_model = "/home/marvin.rajwadi@CHASEITS/KenLM/juju_test/fasttext/lid.176.ftz"
-                self.model = fasttext.load_model(pretrained_lang_model)
-        
-            def predict_lang(self, text):
-                predictions = self.model.predict(text, k=1) # returns top 2 matching languages
-                return predictions
-        LANGUAGE = LanguageIdentification()
-        for idx,te in enumerate([self.tokenizer.decode(j) for j in tokens[0]]):
-            
-            #lang = LANGUAGE.predict_lang(te)
-            #pred_lang=lang[0][0].split("__")[-1].strip()
-            try:
-                pred_lang=detect(te)
+        # the English-output penalty is moot when the audio is already known to be English;
+        # decode the candidates once, and only if the language check or debug output reads them
+        candidate_texts = None
+        if self.options.language != "en" or self.options.debug:
+            candidate_texts = [tokenizer.decode(j) for j in tokens[0]]
+        pred_langs = []
+        if self.options.language != "en":
+            pred_langs = get_language_identification().predict_lang(candidate_texts)
+        for idx, pred_lang in enumerate(pred_langs):
+            if self.options.debug:
                 print(pred_lang)
-            except:
-                pred_lang='unk'
             if pred_lang != "en":# or "danish" in te.lower() or "english" in te.lower() or "translate" in te.lower() or "translation" in te.lower():
-                sum_logprobs[0][idx] = sum_logprobs[0][idx] -7.0
+                ranking_logprobs[0][idx] = ranking_logprobs[0][idx] -7.0
                 #tokens_en.append(tokens[0][idx])
                 #tokens_en_sc.append(sum_logprobs[0][idx])
             # else:
@@ -1222,17 +1351,16 @@ class DecodingTask:
             #     sum_logprobs[0][idx] = sum_logprobs[0][idx] / length_factor
 
         
-        if True:
-            print("Top 5 segments: ",[self.tokenizer.decode(j) for j in tokens[0]])
-            print("top 5 prob: ", sum_logprobs)
+        if self.options.debug:
+            print("Top 5 segments: ", candidate_texts)
+            print("top 5 prob: ", ranking_logprobs)
         # select the top-ranked sample in each group
-        selected = self.sequence_ranker.rank(tokens, sum_logprobs)
+        selected = self.sequence_ranker.rank(tokens, ranking_logprobs)
         #selected_en = self.sequence_ranker.rank(tokens_en, tokens_en_sc)
         #selected_bs = self.sequence_ranker.rank(tokens_bs, tokens_bs_sc)
         tokens: List[List[int]] = [t[i].tolist() for i, t in zip(selected, tokens)]
         texts: List[str] = [tokenizer.decode(t).strip() for t in tokens]
-        #if self.options.debug:
-        if True:
+        if self.options.debug:
             print("selected: ", selected)
             print("top ranked segment: ", texts)
 
@@ -1300,7 +1428,8 @@ def decode(
 
     if kwargs:
         options = replace(options, **kwargs)
-    print(f"temperature: {options.temperature}")
+    if options.debug:
+        print(f"temperature: {options.temperature}")
     result = DecodingTask(model, options).run(mel)
 
     return result[0] if single else result
\ No newline at end of file
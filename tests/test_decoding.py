@@ -0,0 +1,226 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("kenlm")  # imported by whisper.decoding at module level
+
+import torch.nn.functional as F  # noqa: E402
+
+from whisper.decoding import (  # noqa: E402
+    ApplyTimestampRules,
+    BeamSearchDecoder,
+    Inference,
+)
+
+# a small vocabulary: text tokens, then EOT and <|notimestamps|>, then timestamps
+TOKENIZER = SimpleNamespace(eot=10, no_timestamps=11, timestamp_begin=12)
+VOCAB_SIZE = 20
+SAMPLE_BEGIN = 3
+
+
+def reference_apply_timestamp_rules(
+    logits, tokens, tokenizer, sample_begin, max_initial_timestamp_index
+):
+    """The per-row loop implementation that ApplyTimestampRules.apply replaced"""
+    if tokenizer.no_timestamps is not None:
+        logits[:, tokenizer.no_timestamps] = -np.inf
+
+    for k in range(tokens.shape[0]):
+        sampled_tokens = tokens[k, sample_begin:]
+        seq = [t for t in sampled_tokens.tolist()]
+        last_was_timestamp = len(seq) >= 1 and seq[-1] >= tokenizer.timestamp_begin
+        penultimate_was_timestamp = len(seq) < 2 or seq[-2] >= tokenizer.timestamp_begin
+
+        if last_was_timestamp:
+            if penultimate_was_timestamp:
+                logits[k, tokenizer.timestamp_begin :] = -np.inf
+            else:
+                logits[k, : tokenizer.eot] = -np.inf
+
+        timestamps = sampled_tokens[sampled_tokens.ge(tokenizer.timestamp_begin)]
+        if timestamps.numel() > 0:
+            if last_was_timestamp and not penultimate_was_timestamp:
+                timestamp_last = timestamps[-1]
+            else:
+                timestamp_last = timestamps[-1] + 1
+            logits[k, tokenizer.timestamp_begin : timestamp_last] = -np.inf
+
+    if tokens.shape[1] == sample_begin:
+        logits[:, : tokenizer.timestamp_begin] = -np.inf
+        if max_initial_timestamp_index is not None:
+            last_allowed = tokenizer.timestamp_begin + max_initial_timestamp_index
+            logits[:, last_allowed + 1 :] = -np.inf
+
+    logprobs = F.log_softmax(logits.float(), dim=-1)
+    for k in range(tokens.shape[0]):
+        timestamp_logprob = logprobs[k, tokenizer.timestamp_begin :].logsumexp(dim=-1)
+        max_text_token_logprob = logprobs[k, : tokenizer.timestamp_begin].max()
+        if timestamp_logprob > max_text_token_logprob:
+            logits[k, : tokenizer.timestamp_begin] = -np.inf
+
+
+@pytest.mark.parametrize("n_sampled", [0, 1, 2, 5])
+@pytest.mark.parametrize("max_initial_timestamp_index", [None, 3])
+def test_apply_timestamp_rules_matches_reference(n_sampled, max_initial_timestamp_index):
+    generator = torch.Generator().manual_seed(n_sampled)
+    n_batch = 32
+
+    for _ in range(10):
+        prefix = torch.randint(0, TOKENIZER.eot, (n_batch, SAMPLE_BEGIN), generator=generator)
+        # mix text tokens and timestamps, so that every pairing case shows up
+        sampled = torch.where(
+            torch.rand(n_batch, n_sampled, generator=generator) < 0.5,
+            torch.randint(0, TOKENIZER.eot, (n_batch, n_sampled), generator=generator),
+            torch.randint(
+                TOKENIZER.timestamp_begin, VOCAB_SIZE, (n_batch, n_sampled), generator=generator
+            ),
+        )
+        tokens = torch.cat([prefix, sampled], dim=-1)
+        logits = torch.randn(n_batch, VOCAB_SIZE, generator=generator) * 3
+
+        expected = logits.clone()
+        reference_apply_timestamp_rules(
+            expected, tokens, TOKENIZER, SAMPLE_BEGIN, max_initial_timestamp_index
+        )
+        actual = logits.clone()
+        ApplyTimestampRules(TOKENIZER, SAMPLE_BEGIN, max_initial_timestamp_index).apply(
+            actual, tokens
+        )
+
+        assert torch.equal(actual, expected)
+
+
+class RecordingInference(Inference):
+    def __init__(self):
+        self.source_indices = []
+
+    def rearrange_kv_cache(self, source_indices):
+        self.source_indices.append(list(source_indices))
+
+
+class ReferenceBeamSearchDecoder:
+    """The per-beam sort implementation that BeamSearchDecoder.update replaced"""
+
+    def __init__(self, beam_size, eot, inference, patience=None):
+        self.beam_size = beam_size
+        self.eot = eot
+        self.inference = inference
+        self.max_candidates = round(beam_size * (patience or 1.0))
+        self.finished_sequences = None
+
+    def update(self, tokens, logits, sum_logprobs):
+        n_audio = tokens.shape[0] // self.beam_size
+        if self.finished_sequences is None:
+            self.finished_sequences = [{} for _ in range(n_audio)]
+
+        logprobs = F.log_softmax(logits.float(), dim=-1)
+        next_tokens, source_indices, finished_sequences = [], [], []
+        for i in range(n_audio):
+            scores, sources, finished = {}, {}, {}
+            for j in range(self.beam_size):
+                idx = i * self.beam_size + j
+                prefix = tokens[idx].tolist()
+                for logprob, token in zip(*logprobs[idx].topk(self.beam_size + 1)):
+                    sequence = tuple(prefix + [token.item()])
+                    scores[sequence] = (sum_logprobs[idx] + logprob).item()
+                    sources[sequence] = idx
+
+            saved = 0
+            for sequence in sorted(scores, key=scores.get, reverse=True):
+                if sequence[-1] == self.eot:
+                    finished[sequence] = scores[sequence]
+                else:
+                    sum_logprobs[len(next_tokens)] = scores[sequence]
+                    next_tokens.append(sequence)
+                    source_indices.append(sources[sequence])
+                    saved += 1
+                    if saved == self.beam_size:
+                        break
+            finished_sequences.append(finished)
+
+        tokens = torch.tensor(next_tokens, device=tokens.device)
+        self.inference.rearrange_kv_cache(source_indices)
+
+        for previously_finished, newly_finished in zip(
+            self.finished_sequences, finished_sequences
+        ):
+            for seq in sorted(newly_finished, key=newly_finished.get, reverse=True):
+                if len(previously_finished) >= self.max_candidates:
+                    break
+                previously_finished[seq] = newly_finished[seq]
+
+        completed = all(
+            len(sequences) >= self.max_candidates for sequences in self.finished_sequences
+        )
+        return tokens, completed
+
+    def finalize(self, preceding_tokens, sum_logprobs):
+        sum_logprobs = sum_logprobs.cpu()
+        for i, sequences in enumerate(self.finished_sequences):
+            if len(sequences) < self.beam_size:
+                for j in list(np.argsort(sum_logprobs[i]))[::-1]:
+                    sequence = preceding_tokens[i, j].tolist() + [self.eot]
+                    sequences[tuple(sequence)] = sum_logprobs[i][j].item()
+                    if len(sequences) >= self.beam_size:
+                        break
+
+        tokens = [[seq for seq in sequences] for sequences in self.finished_sequences]
+        sum_logprobs = [list(sequences.values()) for sequences in self.finished_sequences]
+        return tokens, sum_logprobs
+
+
+@pytest.mark.parametrize("beam_size", [1, 3, 5])
+@pytest.mark.parametrize("patience", [None, 2.0])
+def test_beam_search_matches_reference(beam_size, patience):
+    generator = torch.Generator().manual_seed(beam_size)
+    n_audio, n_steps, eot = 2, 8, TOKENIZER.eot
+    n_batch = n_audio * beam_size
+
+    reference_inference, inference = RecordingInference(), RecordingInference()
+    reference = ReferenceBeamSearchDecoder(beam_size, eot, reference_inference, patience)
+    decoder = BeamSearchDecoder(beam_size, eot, inference, patience)
+
+    initial = torch.randint(0, eot, (n_audio, SAMPLE_BEGIN), generator=generator)
+    reference_tokens = tokens = initial.repeat_interleave(beam_size, dim=0)
+    reference_sum_logprobs = torch.zeros(n_batch)
+    sum_logprobs = torch.zeros(n_batch)
+
+    for step in range(n_steps):
+        logits = torch.randn(n_batch, VOCAB_SIZE, generator=generator) * 2
+        logits[:, eot] += 1.0  # let some sequences finish along the way
+        if step == 0:
+            # all beams of an audio see the same prefix, hence the same logits
+            logits = logits.view(n_audio, beam_size, -1)[:, :1].expand(-1, beam_size, -1)
+            logits = logits.reshape(n_batch, -1)
+
+        reference_tokens, reference_completed = reference.update(
+            reference_tokens, logits.clone(), reference_sum_logprobs
+        )
+        tokens, completed = decoder.update(tokens, logits.clone(), sum_logprobs)
+
+        assert torch.equal(tokens, reference_tokens)
+        assert torch.allclose(sum_logprobs, reference_sum_logprobs)
+        assert completed == reference_completed
+        if step > 0:
+            # on the first step the beams are interchangeable, so only later reorders must agree
+            assert inference.source_indices[-1] == reference_inference.source_indices[-1]
+        for sequences, reference_sequences in zip(
+            decoder.finished_sequences, reference.finished_sequences
+        ):
+            assert list(sequences) == list(reference_sequences)
+            assert list(sequences.values()) == pytest.approx(list(reference_sequences.values()))
+        if completed:
+            break
+
+    reference_tokens, reference_scores = reference.finalize(
+        reference_tokens.reshape(n_audio, beam_size, -1),
+        reference_sum_logprobs.reshape(n_audio, beam_size),
+    )
+    tokens, scores = decoder.finalize(
+        tokens.reshape(n_audio, beam_size, -1), sum_logprobs.reshape(n_audio, beam_size)
+    )
+    assert [[tuple(t.tolist()) for t in s] for s in tokens] == reference_tokens
+    for audio_scores, reference_audio_scores in zip(scores, reference_scores):
+        assert audio_scores == pytest.approx(reference_audio_scores)